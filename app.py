@@ -0,0 +1,351 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Largest image OpenCV will decode, read once when cv2 is first used
+MAX_IMAGE_PIXELS = 50 * 1000 * 1000
+os.environ.setdefault("OPENCV_IO_MAX_IMAGE_PIXELS", str(MAX_IMAGE_PIXELS))
+
+import cv2
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
+
+try:
+    from python_multipart.exceptions import MultipartParseError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    from multipart.exceptions import MultipartParseError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from emotion_model import MODEL_EXISTS, extract_features, haar_file, labels, model
+
+
+app = FastAPI(title="Mood Detection API")
+
+# ---------- Batch Analysis Limits ----------
+DECODE_WORKERS = 4            # threads decoding images and detecting faces
+MAX_IN_FLIGHT = 32            # uploads read but not yet decoded
+BATCH_SIZE = 64               # faces per model forward pass
+MAX_UPLOAD_FILES = 1000       # files accepted in one request
+MAX_FILE_BYTES = 20 * 1024 * 1024  # size limit of one uploaded image
+SPOOL_MAX_SIZE = 1024 * 1024  # bytes of one upload kept in RAM before spilling to disk
+BATCH_LINGER = 0.25           # seconds a partial batch waits for more faces
+
+decode_executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+# Single worker so forward passes never compete with each other for cores
+inference_executor = ThreadPoolExecutor(max_workers=1)
+
+# CascadeClassifier is not safe to share between threads, keep one per worker
+_thread_state = threading.local()
+
+def get_face_cascade():
+    if not hasattr(_thread_state, "face_cascade"):
+        _thread_state.face_cascade = cv2.CascadeClassifier(haar_file)
+    return _thread_state.face_cascade
+
+class UploadError(Exception):
+    """Malformed or oversized multipart upload"""
+
+# ---------- Multipart Streaming ----------
+class UploadStreamParser:
+    """Incremental multipart parser collecting finished file parts.
+
+    The request body is fed in chunk by chunk, so the caller decides how much
+    of it to read; nothing is buffered beyond the parts still in `parts`.
+    """
+    def __init__(self, boundary):
+        self.parts = deque()  # (filename, file) ready to be decoded
+        self.file_count = 0
+
+        self._header_field = b""
+        self._header_value = b""
+        self._headers = {}
+        self._filename = None
+        self._file = None
+        self._file_bytes = 0
+
+        callbacks = {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        }
+        self.parser = MultipartParser(boundary, callbacks)
+
+    def write(self, chunk):
+        try:
+            self.parser.write(chunk)
+        except MultipartParseError as e:
+            raise UploadError(f"malformed multipart body: {e}")
+
+    def finalize(self):
+        try:
+            self.parser.finalize()
+        except MultipartParseError as e:
+            raise UploadError(f"malformed multipart body: {e}")
+        if self._file is not None:
+            raise UploadError("multipart body ended inside a file")
+
+    def close(self):
+        """Close files of parts that were never handed out"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        while self.parts:
+            self.parts.popleft()[1].close()
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._filename = None
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        filename = options.get(b"filename")
+        if filename is None:
+            return  # Plain form field, ignored
+
+        self.file_count += 1
+        if self.file_count > MAX_UPLOAD_FILES:
+            raise UploadError(f"too many files, the limit is {MAX_UPLOAD_FILES}")
+        self._filename = filename.decode("utf-8", "replace")
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self._file_bytes = 0
+
+    def _on_part_data(self, data, start, end):
+        if self._file is not None:
+            self._file_bytes += end - start
+            if self._file_bytes > MAX_FILE_BYTES:
+                raise UploadError(f"{self._filename} is larger than {MAX_FILE_BYTES} bytes")
+            self._file.write(data[start:end])
+
+    def _on_part_end(self):
+        if self._file is not None:
+            self._file.seek(0)
+            self.parts.append((self._filename, self._file))
+            self._file = None
+
+# ---------- Pipeline Stages ----------
+def decode_upload(filename, file):
+    """Decode one upload and return its face boxes and preprocessed face crops"""
+    result = {"filename": filename, "boxes": [], "faces": None}
+
+    try:
+        data = np.frombuffer(file.read(), dtype=np.uint8)
+    finally:
+        file.close()
+    gray = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE) if data.size else None
+    if gray is None:
+        result["error"] = "could not decode image"
+        return result
+
+    faces = get_face_cascade().detectMultiScale(gray, 1.3, 5)
+    crops = []
+    for (x, y, w, h) in faces:
+        face_img = gray[y:y+h, x:x+w]
+        crops.append(extract_features(cv2.resize(face_img, (48, 48))))
+        result["boxes"].append([int(x), int(y), int(w), int(h)])
+
+    if crops:
+        result["faces"] = np.concatenate(crops).astype(np.float32)
+    return result
+
+def format_result(result, predictions=None):
+    line = {"filename": result["filename"]}
+    if "error" in result:
+        line["error"] = result["error"]
+        return line
+
+    line["faces"] = []
+    for box, prediction in zip(result["boxes"], predictions if predictions is not None else []):
+        line["faces"].append({
+            "box": box,
+            "emotion": labels[int(np.argmax(prediction))],
+            "probabilities": {labels[j]: round(float(p), 4) for j, p in enumerate(prediction)}
+        })
+    return line
+
+def classify_batch(results):
+    """Run one forward pass over every face in the batch, returns one line per image"""
+    faces = np.concatenate([r["faces"] for r in results])
+    predictions = model.predict(faces, batch_size=BATCH_SIZE, verbose=0)
+
+    lines = []
+    offset = 0
+    for result in results:
+        count = len(result["boxes"])
+        lines.append(format_result(result, predictions[offset:offset + count]))
+        offset += count
+    return lines
+
+async def read_chunk(body):
+    """Next body chunk, None once the body is complete"""
+    try:
+        return await body.__anext__()
+    except StopAsyncIteration:
+        return None
+
+async def analyze_uploads(request, parser):
+    """Parse the body incrementally and yield one NDJSON line per image.
+
+    More of the body is only read while fewer than MAX_IN_FLIGHT uploads wait
+    to be decoded and the next batch is not yet full, so a slow model pushes
+    back on the client instead of filling memory. Reading, decoding and the
+    forward pass all run concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    body = request.stream()
+    read_task = None        # next body chunk
+    disconnect_task = None  # watches for the client leaving once the body is read
+    classify_task = None    # forward pass in progress
+    body_done = False
+    pending = set()
+    ready = []              # decoded images with faces, waiting for a forward pass
+    ready_since = None      # when the oldest image in `ready` arrived
+
+    try:
+        while True:
+            face_count = sum(len(r["boxes"]) for r in ready)
+            # Stop taking in uploads while the next batch is already full
+            has_room = face_count < BATCH_SIZE
+
+            # Hand finished parts to the decode pool, up to the in-flight limit
+            while parser.parts and has_room and len(pending) < MAX_IN_FLIGHT:
+                filename, file = parser.parts.popleft()
+                pending.add(loop.run_in_executor(decode_executor, decode_upload, filename, file))
+
+            if (not body_done and read_task is None and not parser.parts
+                    and has_room and len(pending) < MAX_IN_FLIGHT):
+                read_task = asyncio.ensure_future(read_chunk(body))
+
+            # Start a forward pass once the batch is full, no more faces can
+            # arrive, or the oldest image has waited long enough
+            if ready and classify_task is None:
+                no_more = not pending and body_done and not parser.parts
+                if (not has_room or no_more
+                        or loop.time() - ready_since >= BATCH_LINGER):
+                    classify_task = loop.run_in_executor(inference_executor, classify_batch, ready)
+                    ready, ready_since = [], None
+
+            if body_done and not parser.parts and not pending and not ready and classify_task is None:
+                break
+
+            waiting = set(pending)
+            for task in (read_task, disconnect_task, classify_task):
+                if task is not None:
+                    waiting.add(task)
+            timeout = None
+            if ready and classify_task is None:
+                timeout = max(0, ready_since + BATCH_LINGER - loop.time())
+            if waiting:
+                done, _ = await asyncio.wait(waiting, timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(timeout or 0)
+                done = set()
+
+            if disconnect_task in done:
+                raise ClientDisconnect()
+
+            if read_task in done:
+                task, read_task = read_task, None
+                chunk = task.result()  # Raises ClientDisconnect if the client left mid-upload
+                if chunk is not None:
+                    parser.write(chunk)
+                else:
+                    parser.finalize()
+                    body_done = True
+                    if parser.file_count == 0:
+                        raise UploadError("no files in upload")
+                    # Reading from receive() is safe now the body is consumed
+                    disconnect_task = asyncio.ensure_future(request.receive())
+
+            for future in done & pending:
+                pending.discard(future)
+                result = future.result()
+                if result["faces"] is None:
+                    # Nothing to classify, stream it right away
+                    yield json.dumps(format_result(result)) + "\n"
+                else:
+                    if not ready:
+                        ready_since = loop.time()
+                    ready.append(result)
+
+            if classify_task in done:
+                task, classify_task = classify_task, None
+                for line in task.result():
+                    yield json.dumps(line) + "\n"
+    finally:
+        # Client went away or something failed, drop the remaining work
+        for task in (read_task, disconnect_task, classify_task):
+            if task is not None:
+                task.cancel()
+        for future in pending:
+            future.cancel()
+        parser.close()
+
+class BatchAnalysisResponse(StreamingResponse):
+    """NDJSON response for analyze_uploads.
+
+    StreamingResponse listens for disconnects on receive() while streaming,
+    which would steal the request body we are still reading. Here the body
+    iterator does its own disconnect handling, and the response start is held
+    back until the first line is ready so early upload errors still get a 400.
+    """
+    async def __call__(self, scope, receive, send):
+        started = False
+        try:
+            async for line in self.body_iterator:
+                if not started:
+                    await send({"type": "http.response.start", "status": self.status_code,
+                                "headers": self.raw_headers})
+                    started = True
+                await send({"type": "http.response.body", "body": line.encode(), "more_body": True})
+        except ClientDisconnect:
+            return
+        except UploadError as e:
+            if not started:
+                response = JSONResponse({"detail": str(e)}, status_code=400)
+                await response(scope, receive, send)
+                return
+            error_line = json.dumps({"error": str(e)}) + "\n"
+            await send({"type": "http.response.body", "body": error_line.encode(), "more_body": True})
+
+        if not started:
+            await send({"type": "http.response.start", "status": self.status_code,
+                        "headers": self.raw_headers})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+# ---------- Routes ----------
+@app.post("/analyze/batch")
+async def analyze_batch(request: Request):
+    """Analyze many uploaded images, streaming one NDJSON line per image as it finishes"""
+    if not MODEL_EXISTS:
+        raise HTTPException(status_code=503, detail="Emotion detection model not found")
+
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+    parser = UploadStreamParser(boundary)
+    return BatchAnalysisResponse(analyze_uploads(request, parser), media_type="application/x-ndjson")
@@ -1,6 +1,12 @@
+import argparse
 import asyncio
+import json
 import os
+import queue
 import random
+import subprocess
+import sys
+import tempfile
 import time
 import threading
 import cv2
@@ -8,7 +14,14 @@ import numpy as np
 import tkinter as tk
 from tkinter import ttk, messagebox
 from PIL import Image, ImageTk
-from keras.models import load_model
+from thread_budget import (THREAD_PROFILE, THREAD_PROFILE_PATH, apply_thread_profile,
+                           load_thread_profile, pin_current_thread)
+
+# Thread pools must be sized, and this thread pinned to the inference CPUs,
+# before emotion_model loads the model and TensorFlow creates its pools
+apply_thread_profile(THREAD_PROFILE)
+
+from emotion_model import MODEL_EXISTS, extract_features, face_cascade, labels, model
 
 
 PRIMARY_COLOR = "#4a6fa5"
@@ -18,30 +31,6 @@ BACKGROUND_COLOR = "#f5f7fa"
 TEXT_COLOR = "#333333"
 CARD_BG = "#ffffff"
 
-MODEL_PATH = "emotiondetector.h5"
-if not os.path.exists(MODEL_PATH):
-    print(f"Warning: Model file {MODEL_PATH} not found. Emotion detection will not work.")
-    MODEL_EXISTS = False
-else:
-    MODEL_EXISTS = True
-
-    model = load_model(MODEL_PATH)
-
-haar_file = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-face_cascade = cv2.CascadeClassifier(haar_file)
-
-
-labels = {
-    0: 'angry',
-    1: 'disgust',
-    2: 'fear',
-    3: 'happy',
-    4: 'neutral',
-    5: 'sad',
-    6: 'surprise'
-}
-
-
 emotion_colors = {
     'angry': '#FF5733',     # Red
     'disgust': '#6E8B3D',   # Olive
@@ -55,12 +44,6 @@ emotion_colors = {
 # Simple in-memory user database
 users = {}
 
-# ---------- Feature Extraction ----------
-def extract_features(image):
-    feature = np.array(image)
-    feature = feature.reshape(1, 48, 48, 1)
-    return feature / 255.0
-
 # Convert hex color to BGR for OpenCV
 def hex_to_bgr(hex_color):
     hex_color = hex_color.lstrip('#')
@@ -174,6 +157,148 @@ class ChatBot:
             return True
         return False
 
+# ---------- Session Recording ----------
+RECORDINGS_DIR = "recordings"
+
+class SessionRecorder:
+    """Writes annotated frames and a JSONL timeline from a background thread.
+
+    The detection loop only hands frames to a bounded queue; when the writer
+    falls behind, new frames are dropped instead of slowing down live video.
+    Frames arrive at the detection rate, so the writer repeats or skips them
+    to keep the video at a fixed fps in step with the timeline timestamps.
+    """
+    def __init__(self, output_dir=RECORDINGS_DIR, fps=20.0, queue_size=64,
+                 max_segment_bytes=100 * 1024 * 1024, max_segment_seconds=300,
+                 fourcc="mp4v"):
+        self.output_dir = output_dir
+        self.fps = fps
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_seconds = max_segment_seconds
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.session_name = self._unique_session_name()
+        
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.writer_thread = None
+        
+        # Counters for status reporting
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.segment_index = 0
+        self.error = None
+        
+        # Current segment
+        self.video_writer = None
+        self.timeline_file = None
+        self.video_path = None
+        self.segment_start = 0
+        self.segment_frames = 0
+    
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.stop_event.clear()
+        self.writer_thread = threading.Thread(target=self._run)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+    
+    def stop(self):
+        """Signal the writer to flush queued frames and close the current segment.
+
+        Returns immediately, use is_running to see when the writer has finished.
+        """
+        self.stop_event.set()
+    
+    def is_running(self):
+        return self.writer_thread is not None and self.writer_thread.is_alive()
+    
+    def submit(self, frame, detections):
+        """Queue an annotated BGR frame with its detections, never blocks"""
+        try:
+            self.queue.put_nowait((time.time(), frame, detections))
+            return True
+        except queue.Full:
+            self.frames_dropped += 1
+            return False
+    
+    def backlog(self):
+        return self.queue.qsize()
+    
+    def _run(self):
+        pin_current_thread("record")
+        try:
+            while not (self.stop_event.is_set() and self.queue.empty()):
+                try:
+                    timestamp, frame, detections = self.queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                
+                if self.video_writer is None or self._segment_full(timestamp):
+                    self._open_segment(frame, timestamp)
+                
+                # Video frame showing this timestamp, repeat the frame until
+                # the video catches up or skip it if already past
+                segment_frame = int((timestamp - self.segment_start) * self.fps)
+                while self.segment_frames <= segment_frame:
+                    self.video_writer.write(frame)
+                    self.segment_frames += 1
+                
+                self.timeline_file.write(json.dumps({
+                    "frame": self.frames_written,
+                    "segment": self.segment_index,
+                    "segment_frame": segment_frame,
+                    "timestamp": timestamp,
+                    "faces": detections
+                }) + "\n")
+                self.frames_written += 1
+        except Exception as e:
+            self.error = str(e)
+            print(f"Error in session recording: {e}")
+        finally:
+            self._close_segment()
+    
+    def _unique_session_name(self):
+        """Millisecond timestamp, with a counter if files of that name already exist"""
+        now = time.time()
+        name = time.strftime("session_%Y%m%d_%H%M%S", time.localtime(now)) + f"_{int(now * 1000) % 1000:03d}"
+        candidate, counter = name, 1
+        while os.path.exists(os.path.join(self.output_dir, f"{candidate}_001.mp4")):
+            counter += 1
+            candidate = f"{name}_{counter}"
+        return candidate
+    
+    def _segment_full(self, timestamp):
+        if timestamp - self.segment_start >= self.max_segment_seconds:
+            return True
+        try:
+            return os.path.getsize(self.video_path) >= self.max_segment_bytes
+        except OSError:
+            return False
+    
+    def _open_segment(self, frame, timestamp):
+        self._close_segment()
+        self.segment_index += 1
+        base = os.path.join(self.output_dir, f"{self.session_name}_{self.segment_index:03d}")
+        h, w = frame.shape[:2]
+        
+        self.video_path = base + ".mp4"
+        self.video_writer = cv2.VideoWriter(self.video_path, self.fourcc, self.fps, (w, h))
+        if not self.video_writer.isOpened():
+            self.video_writer = None
+            raise RuntimeError(f"Could not open video writer for {self.video_path}")
+        
+        self.timeline_file = open(base + ".jsonl", "w")
+        self.segment_start = timestamp
+        self.segment_frames = 0
+    
+    def _close_segment(self):
+        if self.video_writer is not None:
+            self.video_writer.release()
+            self.video_writer = None
+        if self.timeline_file is not None:
+            self.timeline_file.close()
+            self.timeline_file = None
+
 # ---------- Main Application ----------
 class EmotionChatbotApp:
     def __init__(self, root):
@@ -206,6 +331,18 @@ class EmotionChatbotApp:
         self.webcam_active = False
         self.stop_threads = False
         
+        # Latest frame waiting to be drawn by the Tk thread
+        self.display_frame = None
+        self.display_lock = threading.Lock()
+        
+        # Session recorder, None when not recording
+        self.recorder = None
+        # Stopped recorder still writing out its queue
+        self.finishing_recorder = None
+        
+        # Finish recording before the window goes away
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
         # Initially show login frame
         self.show_frame(self.login_frame)
 
@@ -394,6 +531,18 @@ class EmotionChatbotApp:
         self.video_canvas = tk.Canvas(video_section, width=640, height=480, bg="black", highlightthickness=0)
         self.video_canvas.pack(pady=10)
         
+        # Recording controls
+        record_bar = tk.Frame(video_section, bg=BACKGROUND_COLOR)
+        record_bar.pack(fill="x")
+        
+        self.record_btn = tk.Button(record_bar, text="Start Recording",
+                                    command=self.toggle_recording, **self.button_style)
+        self.record_btn.pack(side="left")
+        
+        self.record_status = tk.Label(record_bar, text="", font=self.label_font,
+                                      fg=TEXT_COLOR, bg=BACKGROUND_COLOR)
+        self.record_status.pack(side="left", padx=10)
+        
         # Emotion display section (right)
         emotion_section = tk.Frame(content, bg=BACKGROUND_COLOR)
         emotion_section.pack(side="right", fill="both", expand=True, padx=20)
@@ -546,6 +695,16 @@ class EmotionChatbotApp:
         self.webcam_active = True
         self.stop_threads = False
         
+        # Latest captured frame shared with the detection thread
+        self.latest_frame = None
+        self.frame_lock = threading.Lock()
+        self.frame_ready = threading.Event()
+        
+        # Start capture thread
+        self.capture_thread = threading.Thread(target=self.capture_frames)
+        self.capture_thread.daemon = True
+        self.capture_thread.start()
+        
         # Start emotion detection thread
         self.emotion_thread = threading.Thread(target=self.detect_emotion)
         self.emotion_thread.daemon = True
@@ -554,21 +713,113 @@ class EmotionChatbotApp:
     def stop_webcam(self):
         self.webcam_active = False
         self.stop_threads = True
+        self.stop_recording()
         
         # Release resources
         if self.cap:
             self.cap.release()
     
+    def toggle_recording(self):
+        if self.recorder:
+            self.stop_recording()
+        else:
+            self.start_recording()
+    
+    def start_recording(self):
+        recorder = SessionRecorder()
+        recorder.start()
+        self.recorder = recorder
+        self.record_btn.config(text="Stop Recording")
+        self.record_status.config(text="Recording...")
+        self.root.after(500, self.check_recorder, recorder)
+    
+    def check_recorder(self, recorder):
+        """Stop recording if the writer thread has died, e.g. no video encoder"""
+        if self.recorder is not recorder:
+            return
+        if recorder.is_running():
+            self.root.after(500, self.check_recorder, recorder)
+        else:
+            self.stop_recording()
+    
+    def stop_recording(self):
+        if not self.recorder:
+            return
+        recorder = self.recorder
+        self.recorder = None
+        recorder.stop()
+        self.finishing_recorder = recorder
+        
+        # Don't allow a new recording until this one is written out
+        self.record_btn.config(text="Start Recording", state="disabled")
+        self.record_status.config(text="Finishing recording...")
+        self.wait_for_recorder(recorder)
+    
+    def wait_for_recorder(self, recorder):
+        if recorder.is_running():
+            self.root.after(100, self.wait_for_recorder, recorder)
+            return
+        
+        if self.finishing_recorder is recorder:
+            self.finishing_recorder = None
+        
+        if recorder.error:
+            text = f"Recording failed: {recorder.error}"
+        else:
+            text = f"Saved {recorder.frames_written} frames to {recorder.output_dir}/"
+        self.record_status.config(text=text)
+        self.record_btn.config(state="normal")
+    
+    def on_close(self):
+        self.stop_threads = True
+        self.stop_recording()
+        self.close_when_recorder_done()
+    
+    def close_when_recorder_done(self):
+        # The writer is a daemon thread, destroying now would leave the last MP4 unfinished
+        if self.finishing_recorder and self.finishing_recorder.is_running():
+            self.root.after(100, self.close_when_recorder_done)
+            return
+        self.stop_webcam()
+        self.root.destroy()
+    
+    def update_record_status(self, recorder):
+        text = (f"Recording - backlog {recorder.backlog()}, "
+                f"dropped {recorder.frames_dropped}")
+        
+        def update_text():
+            # Ignore late updates once recording has stopped
+            if self.recorder is recorder:
+                self.record_status.config(text=text)
+        
+        self.root.after(0, update_text)
+    
+    def capture_frames(self):
+        pin_current_thread("capture")
+        
+        while self.webcam_active and not self.stop_threads:
+            ret, frame = self.cap.read()
+            if not ret:
+                continue
+            
+            # Keep only the newest frame so detection never works on a backlog
+            with self.frame_lock:
+                self.latest_frame = frame
+            self.frame_ready.set()
+    
     def detect_emotion(self):
+        pin_current_thread("inference")
         last_emotion = None
         last_response_time = 0
         
         while self.webcam_active and not self.stop_threads:
             try:
-                # Read frame from webcam
-                ret, frame = self.cap.read()
-                if not ret:
+                # Wait for the next frame from the capture thread
+                if not self.frame_ready.wait(timeout=0.5):
                     continue
+                with self.frame_lock:
+                    frame = self.latest_frame
+                    self.frame_ready.clear()
                 
                 # Create a copy for drawing
                 display_frame = frame.copy()
@@ -596,9 +847,17 @@ class EmotionChatbotApp:
                     # Update UI
                     self.update_emotion(current_emotion)
                     
+                    recorder = self.recorder
+                    if recorder:
+                        recorder.submit(display_frame, [{
+                            "box": [fake_x, fake_y, fake_w, fake_h],
+                            "emotion": current_emotion,
+                            "probabilities": None
+                        }])
+                        self.update_record_status(recorder)
+                    
                     # Show the frame
-                    rgb_frame = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)
-                    self.update_frame(rgb_frame)
+                    self.update_frame(display_frame)
                     
                     time.sleep(3)  # Wait longer for simulated emotions
                     continue
@@ -608,6 +867,7 @@ class EmotionChatbotApp:
                 faces = face_cascade.detectMultiScale(gray, 1.3, 5)
                 
                 current_emotion = None
+                detections = []
                 for i, (x, y, w, h) in enumerate(faces):
                     # Draw rectangle around face
                     cv2.rectangle(display_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
@@ -620,6 +880,12 @@ class EmotionChatbotApp:
                     # Get emotion prediction
                     prediction = model.predict(processed_face, verbose=0)
                     emotion = labels[np.argmax(prediction)]
+                    detections.append({
+                        "box": [int(x), int(y), int(w), int(h)],
+                        "emotion": emotion,
+                        "probabilities": {labels[j]: round(float(p), 4)
+                                          for j, p in enumerate(prediction[0])}
+                    })
                     
                     # Only update UI with first face emotion
                     if i == 0:
@@ -647,11 +913,14 @@ class EmotionChatbotApp:
                         )
                         last_response_time = current_time
                 
-                # Convert to RGB for tkinter display
-                rgb_frame = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)
+                # Hand the annotated frame to the recorder without blocking
+                recorder = self.recorder
+                if recorder:
+                    recorder.submit(display_frame, detections)
+                    self.update_record_status(recorder)
                 
                 # Update UI on main thread
-                self.update_frame(rgb_frame)
+                self.update_frame(display_frame)
             
             except Exception as e:
                 print(f"Error in emotion detection: {e}")
@@ -659,9 +928,24 @@ class EmotionChatbotApp:
             time.sleep(0.03)  # ~30 FPS
     
     def update_frame(self, frame):
-        """Update the video canvas with the provided frame"""
+        """Hand a BGR frame to the Tk thread, which converts and draws it"""
+        # Keep only the newest frame if the Tk loop falls behind
+        with self.display_lock:
+            scheduled = self.display_frame is not None
+            self.display_frame = frame
+        if not scheduled:
+            self.root.after(0, self.render_frame)
+    
+    def render_frame(self):
+        """Convert the latest frame and draw it on the video canvas (Tk thread)"""
+        with self.display_lock:
+            frame, self.display_frame = self.display_frame, None
+        if frame is None:
+            return
+        
         # Convert to PhotoImage
-        img = Image.fromarray(frame)
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        img = Image.fromarray(rgb_frame)
         imgtk = ImageTk.PhotoImage(image=img)
         
         # Update canvas
@@ -706,8 +990,130 @@ class EmotionChatbotApp:
         
         self.root.after(0, update_text)
 
+# ---------- Benchmark & Auto-tune ----------
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def run_benchmark(frames=150, fps=30):
+    """Time detection frames while capture and render load compete for the CPU.
+
+    Returns (mean, p95, p99) frame times in ms.
+    """
+    rng = np.random.default_rng(0)
+    color_frame = rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    processed_face = extract_features(rng.integers(0, 256, (48, 48), dtype=np.uint8))
+    stop = threading.Event()
+    
+    # Stand-ins for the capture thread and the Tk loop converting frames for
+    # display, which is the work render_frame does on the "render" thread
+    def capture_load():
+        pin_current_thread("capture")
+        while not stop.is_set():
+            color_frame.copy()
+            time.sleep(1 / fps)
+    
+    def render_load():
+        pin_current_thread("render")
+        while not stop.is_set():
+            rgb_frame = cv2.cvtColor(color_frame, cv2.COLOR_BGR2RGB)
+            Image.fromarray(rgb_frame).tobytes()
+            time.sleep(1 / fps)
+    
+    def step():
+        display_frame = color_frame.copy()
+        gray = cv2.cvtColor(display_frame, cv2.COLOR_BGR2GRAY)
+        face_cascade.detectMultiScale(gray, 1.3, 5)
+        if MODEL_EXISTS:
+            model.predict(processed_face, verbose=0)
+    
+    load_threads = [threading.Thread(target=capture_load), threading.Thread(target=render_load)]
+    for t in load_threads:
+        t.daemon = True
+        t.start()
+    
+    pin_current_thread("inference")
+    step()  # Warm-up
+    timings = []
+    try:
+        for _ in range(frames):
+            start = time.perf_counter()
+            step()
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        stop.set()
+    
+    return sum(timings) / len(timings), percentile(timings, 95), percentile(timings, 99)
+
+def autotune(frames=150):
+    """Benchmark thread settings in fresh processes and save the profile with the lowest frame times"""
+    cores = os.cpu_count() or 1
+    thread_counts = sorted({1, 2, max(1, cores // 2), cores})
+    base = load_thread_profile()
+    
+    # TensorFlow pools can only be sized once per process, so every
+    # candidate runs the benchmark in its own subprocess
+    candidates = [dict(base, tf_intra_op_threads=0, tf_inter_op_threads=0, cv2_threads=-1)]
+    for intra in thread_counts:
+        for inter in (1, 2):
+            for cv_threads in thread_counts:
+                candidates.append(dict(base, tf_intra_op_threads=intra,
+                                       tf_inter_op_threads=inter, cv2_threads=cv_threads))
+    
+    best_profile, best_score = None, None
+    for candidate in candidates:
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(candidate, f)
+        try:
+            env = dict(os.environ, MOOD_THREAD_PROFILE=f.name)
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--benchmark", "--frames", str(frames)],
+                env=env, capture_output=True, text=True
+            )
+        finally:
+            os.remove(f.name)
+        
+        timings = [line.split()[1:] for line in result.stdout.splitlines()
+                   if line.startswith("BENCHMARK_MS ")]
+        if result.returncode != 0 or not timings:
+            print(f"Skipping {candidate}: benchmark failed")
+            continue
+        mean, p95, p99 = (float(v) for v in timings[-1])
+        # Jitter matters as much as throughput, so tail latency counts as much as the mean
+        score = mean + p95 + p99
+        print(f"intra={candidate['tf_intra_op_threads']} inter={candidate['tf_inter_op_threads']} "
+              f"cv2={candidate['cv2_threads']}: mean {mean:.2f} p95 {p95:.2f} p99 {p99:.2f} ms/frame")
+        if best_score is None or score < best_score:
+            best_profile, best_score = candidate, score
+    
+    if best_profile is None:
+        print("Auto-tune failed: no benchmark run completed")
+        return None
+    
+    with open(THREAD_PROFILE_PATH, "w") as f:
+        json.dump(best_profile, f, indent=4)
+    print(f"Best profile written to {THREAD_PROFILE_PATH}")
+    return best_profile
+
 # Entry point
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = EmotionChatbotApp(root)
-    root.mainloop()
+    parser = argparse.ArgumentParser(description="Mood Detection With Chatbot")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="time the detection pipeline with the current thread profile")
+    parser.add_argument("--autotune", action="store_true",
+                        help="sweep thread settings and save the fastest profile")
+    parser.add_argument("--frames", type=int, default=150,
+                        help="frames per benchmark run")
+    args = parser.parse_args()
+    
+    if args.benchmark:
+        mean, p95, p99 = run_benchmark(args.frames)
+        print(f"BENCHMARK_MS {mean:.3f} {p95:.3f} {p99:.3f}")
+    elif args.autotune:
+        autotune(args.frames)
+    else:
+        pin_current_thread("render")
+        root = tk.Tk()
+        app = EmotionChatbotApp(root)
+        root.mainloop()
@@ -0,0 +1,38 @@
+import os
+
+import cv2
+import numpy as np
+from keras.models import load_model
+
+
+# No thread profile is applied here: the desktop app applies its own before
+# importing this module, and the API server keeps TensorFlow's defaults
+MODEL_PATH = "emotiondetector.h5"
+model = None
+if not os.path.exists(MODEL_PATH):
+    print(f"Warning: Model file {MODEL_PATH} not found. Emotion detection will not work.")
+    MODEL_EXISTS = False
+else:
+    MODEL_EXISTS = True
+
+    model = load_model(MODEL_PATH)
+
+haar_file = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+face_cascade = cv2.CascadeClassifier(haar_file)
+
+
+labels = {
+    0: 'angry',
+    1: 'disgust',
+    2: 'fear',
+    3: 'happy',
+    4: 'neutral',
+    5: 'sad',
+    6: 'surprise'
+}
+
+# ---------- Feature Extraction ----------
+def extract_features(image):
+    feature = np.array(image)
+    feature = feature.reshape(1, 48, 48, 1)
+    return feature / 255.0
@@ -0,0 +1,99 @@
+import copy
+import json
+import os
+
+import cv2
+import tensorflow as tf
+
+
+# ---------- Thread Budget ----------
+# Per-machine thread settings, written by `python app_copy.py --autotune`.
+# MOOD_THREAD_PROFILE can point to a different profile file.
+THREAD_PROFILE_PATH = os.environ.get("MOOD_THREAD_PROFILE", "thread_profile.json")
+
+STAGES = ("capture", "inference", "render", "record")
+
+DEFAULT_THREAD_PROFILE = {
+    "tf_intra_op_threads": 0,   # 0 = TensorFlow default
+    "tf_inter_op_threads": 0,   # 0 = TensorFlow default
+    "cv2_threads": -1,          # negative = OpenCV default
+    "affinity": {stage: None for stage in STAGES}  # list of CPU ids per stage, None = not pinned
+}
+
+# CPU mask the process started with, stages without pinning are reset to it
+if hasattr(os, "sched_getaffinity"):
+    PROCESS_CPUS = os.sched_getaffinity(0)
+else:
+    PROCESS_CPUS = None
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _validate_profile(saved):
+    if not isinstance(saved, dict):
+        raise ValueError("top level must be an object")
+    for key in ("tf_intra_op_threads", "tf_inter_op_threads", "cv2_threads"):
+        if key in saved and not _is_int(saved[key]):
+            raise ValueError(f"{key} must be an integer")
+    for key in ("tf_intra_op_threads", "tf_inter_op_threads"):
+        if saved.get(key, 0) < 0:
+            raise ValueError(f"{key} must not be negative")
+
+    affinity = saved.get("affinity") or {}
+    if not isinstance(affinity, dict):
+        raise ValueError("affinity must be an object")
+    for stage, cpus in affinity.items():
+        if stage not in STAGES:
+            raise ValueError(f"unknown affinity stage {stage!r}")
+        if cpus is not None and not (isinstance(cpus, list) and cpus
+                                     and all(_is_int(c) and c >= 0 for c in cpus)):
+            raise ValueError(f"affinity for {stage} must be null or a list of CPU ids")
+
+def load_thread_profile(path=THREAD_PROFILE_PATH):
+    """Read the thread profile, falling back to the defaults if it is missing or invalid"""
+    profile = copy.deepcopy(DEFAULT_THREAD_PROFILE)
+    if not os.path.exists(path):
+        return profile
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        _validate_profile(saved)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read thread profile {path}: {e}")
+        return profile
+
+    profile["affinity"].update(saved.pop("affinity", None) or {})
+    profile.update(saved)
+    return profile
+
+def apply_thread_profile(profile):
+    """Apply thread pool sizes, must run before TensorFlow executes any op.
+
+    The calling thread is also pinned to the inference CPUs, so the TensorFlow
+    worker pools created afterwards (e.g. by load_model) inherit that mask.
+    Other stages re-pin themselves with pin_current_thread.
+    """
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(profile["tf_intra_op_threads"])
+        tf.config.threading.set_inter_op_parallelism_threads(profile["tf_inter_op_threads"])
+    except RuntimeError as e:
+        print(f"Warning: TensorFlow thread settings not applied: {e}")
+    cv2.setNumThreads(profile["cv2_threads"])
+    pin_current_thread("inference", profile)
+
+def pin_current_thread(stage, profile=None):
+    """Pin the calling thread to the CPUs of a pipeline stage.
+
+    Threads inherit the mask of the thread that created them, so a stage
+    without pinning is reset to the process mask instead of being left alone.
+    """
+    if PROCESS_CPUS is None:
+        return
+    profile = profile or THREAD_PROFILE
+    cpus = profile["affinity"].get(stage) or PROCESS_CPUS
+    try:
+        os.sched_setaffinity(0, cpus)  # 0 = calling thread on Linux
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not pin {stage} thread to CPUs {cpus}: {e}")
+
+THREAD_PROFILE = load_thread_profile()